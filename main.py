@@ -1,40 +1,261 @@
 # main.py - RIVX Crypto Bot using CoinGecko API with styled image and text fallback
 import os
 import io
-import requests
+import re
+import functools
+import asyncio
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
 import logging
 import time
-import random
-import matplotlib.pyplot as plt
+from collections import OrderedDict
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image, ImageDraw, ImageFont
-from datetime import datetime
 from telegram import Update, InputFile
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.ext import (AIORateLimiter, Application, ApplicationBuilder,
+                          CommandHandler, ContextTypes)
 from dotenv import load_dotenv
-import nest_asyncio
+from yarl import URL
+
+try:
+    import cv2  # optional: k-means dominant color
+except ImportError:
+    cv2 = None
+
+try:
+    import uvloop  # optional: faster event loop (not available on Windows)
+except ImportError:
+    uvloop = None
 
 # === Load Environment ===
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-COINGECKO_API = "https://api.coingecko.com/api/v3"
+# Parsed once; paths are appended with / without re-parsing the base
+COINGECKO_API = URL("https://api.coingecko.com/api/v3")
 
 # === Logging ===
-logging.basicConfig(level=logging.INFO)
+# Messages use lazy %-formatting, so records below LOG_LEVEL cost almost
+# nothing; set LOG_LEVEL=WARNING in production to drop the INFO chatter.
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # === Rate Limiting ===
-LAST_API_CALL = time.time()
-API_DELAY = 1.5  # 1.5 seconds between calls for 40 calls/minute
+# CoinGecko's free tier allows 30 calls/minute. The limiter is shared by
+# every coroutine, so concurrent commands can't overshoot the budget.
+RATE_LIMITER = AsyncLimiter(30, 60)
+
+# === Caching ===
+TOKEN_TTL = 60  # /coins/markets rows
+CHART_TTL = 5 * 60  # /coins/{id}/market_chart/range; 5-minute points
+CHART_WINDOW_HOURS = 24
+# symbol_map.json built from /coins/list; override with SYMBOL_MAP_TTL
+LIST_TTL = int(os.getenv("SYMBOL_MAP_TTL", 24 * 60 * 60))
+LOGO_TTL = 24 * 60 * 60  # logo images rarely change
+CACHE_MAX_ENTRIES = 1024
+
+
+class TTLCache:
+    """In-process LRU cache of API payloads with a per-key expiry.
+
+    Concurrent misses for the same key share one fetch: later callers await
+    the first caller's in-flight task, so they also share a failed (None)
+    result instead of each retrying upstream in turn.
+    """
+
+    def __init__(self, maxsize=CACHE_MAX_ENTRIES):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._inflight = {}  # key -> asyncio.Task of the running fetch
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, key, ttl, fetch):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, ttl, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded so one caller giving up doesn't cancel the others' fetch
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, ttl, fetch):
+        value = await fetch()
+        if value is not None:
+            self.set(key, value, ttl)
+        return value
+
+
+CACHE = TTLCache()
+
+# Negative cache: ids CoinGecko answered 404 for (mostly typos), so
+# repeats are rejected without a network round-trip.
+UNKNOWN_TOKEN_TTL = 10 * 60
+UNKNOWN_TOKENS_MAX = 4096
+UNKNOWN_TOKENS = OrderedDict()  # coin_id -> expiry
+
+
+def is_unknown_token(coin_id):
+    expiry = UNKNOWN_TOKENS.get(coin_id)
+    if expiry is None:
+        return False
+    if expiry > time.monotonic():
+        return True
+    del UNKNOWN_TOKENS[coin_id]
+    return False
+
+
+def remember_unknown_token(coin_id):
+    UNKNOWN_TOKENS[coin_id] = time.monotonic() + UNKNOWN_TOKEN_TTL
+    UNKNOWN_TOKENS.move_to_end(coin_id)
+    if len(UNKNOWN_TOKENS) > UNKNOWN_TOKENS_MAX:
+        UNKNOWN_TOKENS.popitem(last=False)
+
+
+# Replies being built right now, so a burst of identical commands shares
+# one fetch + render instead of racing to do the same work N times.
+INFLIGHT = {}  # (kind, coin_id) -> asyncio.Task
+
+
+def coalesce(key, build):
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(build())
+        INFLIGHT[key] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+    # Shielded so one caller giving up doesn't cancel the others' work
+    return asyncio.shield(task)
+
+
+# Per-user cap on commands in flight, so one user flooding /p can't hold
+# every upstream slot while others wait. Entries are dropped when idle.
+USER_CONCURRENCY = 2
+USER_SLOTS = {}  # user_id -> [asyncio.Semaphore, callers holding or waiting]
+
+
+def limit_per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        user_id = update.effective_user.id
+        slot = USER_SLOTS.get(user_id)
+        if slot is None:
+            slot = USER_SLOTS[user_id] = [asyncio.Semaphore(USER_CONCURRENCY), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                return await handler(update, context)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del USER_SLOTS[user_id]
+    return wrapper
+
+
+# === HTTP Session ===
+SESSION = None  # shared aiohttp.ClientSession, created by get_session()
+USER_AGENT = "RIVX-Crypto-Bot/1.0 (+https://github.com/voxy100/Telegram-Crypto-Price-Bot)"
+RETRY_STATUSES = {500, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.2  # seconds, doubled on each retry
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10, sock_connect=3, sock_read=8)
+HANDLER_TIMEOUT = 10  # seconds a command may wait on upstream data
+WARMUP_TASK = None  # connection warm-up started in post_init
+
+
+def get_session():
+    # One pooled, keep-alive session for every outbound request, created
+    # lazily because aiohttp sessions must be built inside the running loop.
+    global SESSION
+    if SESSION is None or SESSION.closed:
+        SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100,
+                                           limit_per_host=30,
+                                           keepalive_timeout=75,
+                                           ttl_dns_cache=300),
+            headers={"User-Agent": USER_AGENT},
+            timeout=HTTP_TIMEOUT)
+    return SESSION
+
+
+async def warm_connection():
+    # aiohttp speaks HTTP/1.1 only, so the win is reuse: open the pooled
+    # keep-alive connection at startup so the first command doesn't pay
+    # for DNS and the TLS handshake.
+    await api_request(COINGECKO_API / "ping")
+
 
 # === Symbol Mapping ===
 SYMBOL_TO_ID = {}
+SYMBOL_MAP_FILE = "symbol_map.json"
+SYMBOL_MAP_TASK = None  # background load started in post_init
+SYMBOL_REFRESH_TASK = None  # periodic rebuild started in post_init
+SYMBOL_MAP_RETRY = 10 * 60  # seconds before retrying a failed rebuild
+
+
+def read_symbol_map_file():
+    # Returns (mapping, fresh); a stale map is still worth serving while
+    # a new one is fetched.
+    try:
+        if not os.path.exists(SYMBOL_MAP_FILE):
+            return None, False
+        fresh = time.time() - os.path.getmtime(SYMBOL_MAP_FILE) < LIST_TTL
+        with open(SYMBOL_MAP_FILE, "rb") as f:
+            return orjson.loads(f.read()), fresh
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read %s: %s", SYMBOL_MAP_FILE, e)
+        return None, False
 
 
-def load_symbol_mapping():
+def write_symbol_map_file(mapping):
+    # Write to a temp file and swap it in so a crash never leaves a
+    # truncated map behind.
+    tmp_path = f"{SYMBOL_MAP_FILE}.tmp"
     try:
-        response = requests.get(f"{COINGECKO_API}/coins/list")
-        response.raise_for_status()
-        data = response.json()
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(mapping))
+        os.replace(tmp_path, SYMBOL_MAP_FILE)
+    except OSError as e:
+        logger.warning("Could not write %s: %s", SYMBOL_MAP_FILE, e)
+
+
+async def load_symbol_mapping():
+    # The file is only consulted while nothing is loaded yet; a refresh of
+    # a running bot always rebuilds from CoinGecko.
+    if not SYMBOL_TO_ID:
+        cached, fresh = read_symbol_map_file()
+        if cached:
+            SYMBOL_TO_ID.update(cached)
+            logger.info("✅ Coin symbol mapping loaded from disk")
+            if fresh:
+                return
+
+    try:
+        # Not kept in CACHE: ~17k small dicts are only needed for this pass,
+        # and the map built from them is persisted to disk instead.
+        data = await api_request(COINGECKO_API / "coins" / "list")
+        if data is None:
+            return
 
         priority_map = {
             'btc': 'bitcoin',
@@ -45,244 +266,765 @@ def load_symbol_mapping():
             'doge': 'dogecoin',
         }
 
+        # Built aside and swapped in, so a stale map keeps serving meanwhile
+        mapping = {}
         for coin in data:
             symbol = coin['symbol'].lower()
             coin_id = coin['id']
-            if symbol not in SYMBOL_TO_ID or priority_map.get(
-                    symbol) == coin_id:
-                SYMBOL_TO_ID[symbol] = coin_id
+            if symbol not in mapping or priority_map.get(symbol) == coin_id:
+                mapping[symbol] = coin_id
+        del data
 
+        # Many coins share a ticker; let the largest by market cap win.
+        # Iterate smallest-first so the bigger coin is written last.
+        top_coins = await api_request(COINGECKO_API / "coins" / "markets", {
+            "vs_currency": "usd",
+            "order": "market_cap_desc",
+            "per_page": 250,
+            "page": 1,
+        })
+        for coin in reversed(top_coins or []):
+            symbol = coin['symbol'].lower()
+            if symbol not in priority_map:
+                mapping[symbol] = coin['id']
+
+        SYMBOL_TO_ID.clear()
+        SYMBOL_TO_ID.update(mapping)
+        write_symbol_map_file(SYMBOL_TO_ID)
         logger.info("✅ Coin symbol mapping loaded")
     except Exception as e:
-        logger.error(f"Error loading symbol mapping: {e}")
+        logger.error("Error loading symbol mapping: %s", e)
+
+
+async def refresh_symbol_mapping():
+    # Rebuild the map whenever symbol_map.json reaches LIST_TTL, so a bot
+    # running for weeks still learns new tickers. A failed rebuild keeps
+    # the current map and is retried after SYMBOL_MAP_RETRY.
+    while True:
+        try:
+            age = time.time() - os.path.getmtime(SYMBOL_MAP_FILE)
+        except OSError:
+            age = 0
+        await asyncio.sleep(max(LIST_TTL - age, SYMBOL_MAP_RETRY))
+        await load_symbol_mapping()
+
+
+async def ensure_symbol_mapping():
+    # The map loads in the background at startup; only commands arriving
+    # before anything is loaded wait for it, and a failed load is retried.
+    global SYMBOL_MAP_TASK
+    if SYMBOL_TO_ID:
+        return
+    if SYMBOL_MAP_TASK is None or SYMBOL_MAP_TASK.done():
+        SYMBOL_MAP_TASK = asyncio.ensure_future(load_symbol_mapping())
+    try:
+        await asyncio.wait_for(asyncio.shield(SYMBOL_MAP_TASK),
+                               HANDLER_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Symbol mapping still loading, resolving by id")
+
+
+def normalize_token(text):
+    # Map keys are lowercased at build time; most input already is too
+    return text if text.islower() else text.lower()
+
+
+# CoinGecko ids are lowercase slugs. Anything else is rejected before a
+# URL is built, so input can't reach other endpoints ("../global") or add
+# ids to a batched ids= list (",").
+COIN_ID_PATTERN = re.compile(r"[a-z0-9-]+")
+
+
+def resolve_coin_id(token):
+    # Symbols map through the prebuilt dict; anything else is assumed to
+    # already be a CoinGecko id (e.g. /p bitcoin). None if it can't be one.
+    coin_id = SYMBOL_TO_ID.get(token, token)
+    return coin_id if COIN_ID_PATTERN.fullmatch(coin_id) else None
 
 
 # === Font Fallback ===
+@functools.lru_cache(maxsize=16)
 def get_font(font_path, size):
     try:
         return ImageFont.truetype(font_path, size)
-    except:
+    except OSError:
         return ImageFont.load_default()
 
 
+# === Card Template ===
+FONT_BOLD = get_font("dejavu-sans-bold.ttf", 40)
+FONT_SMALL = get_font("dejavu-sans.ttf", 20)
+
+
+def build_watermark():
+    # Rendered once onto a transparent tile sized to the text, then
+    # composited over each finished card so it stays above the chart.
+    left, top, right, bottom = FONT_SMALL.getbbox("@rivxlabs", anchor="rs")
+    mark = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+    ImageDraw.Draw(mark).text((-left, -top),
+                              "@rivxlabs",
+                              font=FONT_SMALL,
+                              fill="gray",
+                              anchor="rs")
+    return mark, (760 + left, 370 + top)
+
+
+# Static labels are drawn into the template; cards only draw the value
+# that follows each one, starting where the label's text ends.
+CARD_LABELS = [
+    (30, 190, "Market Cap: ", "gray"),
+    (30, 220, "24h Volume: ", "gray"),
+    (30, 260, "📈 1h: ", "white"),
+    (30, 290, "24h: ", "white"),
+    (30, 320, "7d: ", "white"),
+]
+
+
+def build_card_template():
+    card = Image.new("RGBA", (800, 400), (20, 20, 20))
+    draw = ImageDraw.Draw(card)
+    for x, y, label, color in CARD_LABELS:
+        draw.text((x, y), label, font=FONT_SMALL, fill=color)
+    return card
+
+
+# Background and labels are identical on every card, so each card starts
+# from a copy.
+CARD_TEMPLATE = build_card_template()
+CARD_VALUE_POS = [(x + FONT_SMALL.getlength(label), y, color)
+                  for x, y, label, color in CARD_LABELS]
+WATERMARK, WATERMARK_POS = build_watermark()
+
+
+# === Rendering ===
+# Chart and card rendering is CPU-bound, so it runs in worker processes:
+# the event loop stays free and renders don't contend for one GIL. Workers
+# are spawned rather than forked from the running bot, re-import this
+# module (skipping the __main__ block) and are started lazily on first use.
+# Render functions take and return plain picklable data.
+RENDER_WORKERS = os.cpu_count() or 1
+# Both are created on first use in the bot process only: spawned workers
+# re-import this module and must not build pools of their own.
+RENDER_POOL = None
+# At most one render per worker is handed to the pool; the rest wait here
+# instead of piling their pickled inputs into the pool's queue.
+RENDER_SLOTS = None
+
+
+def get_render_pool():
+    global RENDER_POOL
+    if RENDER_POOL is None:
+        RENDER_POOL = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"))
+    return RENDER_POOL
+
+
+async def render(fn, *args):
+    # A worker dying (OOM kill, segfault) breaks the whole pool; replace it
+    # once and retry, so one crash doesn't disable rendering until restart.
+    global RENDER_POOL, RENDER_SLOTS
+    if RENDER_SLOTS is None:
+        RENDER_SLOTS = asyncio.Semaphore(RENDER_WORKERS)
+    async with RENDER_SLOTS:
+        for attempt in range(2):
+            pool = get_render_pool()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    pool, fn, *args)
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+                if RENDER_POOL is pool:  # not already replaced by another render
+                    logger.warning("Render pool broken, restarting it")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    RENDER_POOL = None
+
+
+# Building a Figure dominates chart render time, so figures are recycled
+# instead of created and closed on every render, with one pool per figure
+# size. Each render worker is a single-threaded process with its own
+# pools, so a plain list is enough.
+FIGURE_POOLS = {}  # figsize -> [Figure, ...]
+
+# /c chart geometry: 800x400 px is sharp on mobile and cheap to encode.
+# Fixed margins replace bbox_inches='tight', which re-lays out the figure
+# on every save.
+CHART_SIZE = (8, 4)
+CHART_DPI = 100
+MS_PER_DAY = 24 * 60 * 60 * 1000
+CHART_MARGINS = dict(left=0.08, right=0.98, top=0.9, bottom=0.15)
+
+# Telegram re-encodes photos anyway, so PNGs are written with fast, light
+# zlib compression instead of Pillow's default level 6.
+PNG_COMPRESS_LEVEL = 1
+
+
+def new_figure(figsize):
+    # Matplotlib is only needed for /c, so it's imported on the first chart:
+    # the bot process and workers that only draw cards never load it.
+    import matplotlib
+    matplotlib.use("Agg")  # headless bot: never load a GUI backend
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize, dpi=CHART_DPI)
+    FigureCanvasAgg(fig)
+    fig.add_subplot()
+    return fig
+
+
+def acquire_figure(figsize, setup):
+    # New figures are styled once by `setup`; pooled ones keep that styling
+    # and only had their data artists removed on release.
+    pool = FIGURE_POOLS.setdefault(figsize, [])
+    if pool:
+        return pool.pop()
+    fig = new_figure(figsize)
+    setup(fig)
+    return fig
+
+
+def release_figure(fig, figsize):
+    ax = fig.axes[0]
+    for artist in ax.lines + ax.collections:
+        artist.remove()
+    ax.relim()
+    FIGURE_POOLS[figsize].append(fig)
+
+
+def setup_chart_figure(fig):
+    import matplotlib.dates as mdates
+
+    fig.subplots_adjust(**CHART_MARGINS)
+    fig.patch.set_facecolor("#141414")
+    ax = fig.axes[0]
+    ax.set_facecolor("#141414")
+    # x values are plain Matplotlib date numbers (see generate_chart), so
+    # the date locator is set explicitly rather than via unit conversion.
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
+    ax.tick_params(colors="gray")
+    ax.grid(color="#333333", linewidth=0.5)
+    for spine in ax.spines.values():
+        spine.set_color("#333333")
+
+
 # === Helper Functions ===
-def api_request(url, params=None):
-    global LAST_API_CALL
+class NotFoundError(Exception):
+    """CoinGecko answered 404 for the requested resource."""
+
+
+async def api_request(url, params=None):
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            async with RATE_LIMITER:
+                async with get_session().get(url, params=params) as response:
+                    if response.status == 404:
+                        raise NotFoundError(url)
+                    if response.status == 429:
+                        reason = "Rate limited"
+                        retry_after = int(
+                            response.headers.get('Retry-After', 60))
+                    elif response.status in RETRY_STATUSES:
+                        reason = f"Server error {response.status}"
+                        retry_after = RETRY_BACKOFF * 2**attempt
+                    else:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+            if attempt < MAX_RETRIES:
+                logger.warning("%s. Retrying after %.1f seconds", reason,
+                               retry_after)
+                await asyncio.sleep(retry_after)
+        raise RuntimeError(f"{reason}, gave up after {MAX_RETRIES} retries")
+    except NotFoundError:
+        raise
+    except Exception as e:
+        logger.error("API request failed: %s", e)
+        return None
+
+
+# Token lookups go through /coins/markets, which returns name, logo and
+# market data as one flat row per coin and accepts a list of ids: lookups
+# arriving within BATCH_WINDOW share one request and one rate-limit slot.
+MARKET_PARAMS = {"vs_currency": "usd", "price_change_percentage": "1h,24h,7d"}
+BATCH_WINDOW = 0.05  # seconds
+BATCH_MAX_IDS = 250  # per_page cap of /coins/markets
+PENDING_TOKENS = {}  # coin_id -> Future of its /coins/markets row
+BATCH_TASK = None
+
+
+def queue_token(coin_id):
+    global BATCH_TASK
+    future = PENDING_TOKENS.get(coin_id)
+    if future is None:
+        future = asyncio.get_running_loop().create_future()
+        PENDING_TOKENS[coin_id] = future
+    if BATCH_TASK is None:
+        BATCH_TASK = asyncio.create_task(flush_token_batch())
+    return future
+
+
+async def flush_token_batch():
+    global BATCH_TASK
+    await asyncio.sleep(BATCH_WINDOW)
+    batch = {
+        coin_id: PENDING_TOKENS.pop(coin_id)
+        for coin_id in list(PENDING_TOKENS)[:BATCH_MAX_IDS]
+    }
+    BATCH_TASK = (asyncio.create_task(flush_token_batch())
+                  if PENDING_TOKENS else None)
+
+    found = None  # coin_id -> row; stays None if the request failed
     try:
-        # Rate limiting
-        elapsed = time.time() - LAST_API_CALL
-        if elapsed < API_DELAY:
-            sleep_time = API_DELAY - elapsed + random.uniform(0.1, 0.5)
-            time.sleep(sleep_time)
-
-        response = requests.get(url, params=params)
-        LAST_API_CALL = time.time()
-
-        if response.status_code == 429:
-            retry_after = int(response.headers.get('Retry-After', 60))
-            logger.warning(
-                f"Rate limited. Retrying after {retry_after} seconds")
-            time.sleep(retry_after)
-            return api_request(url, params)
-
-        response.raise_for_status()
-        return response
+        rows = await api_request(COINGECKO_API / "coins" / "markets", {
+            **MARKET_PARAMS,
+            "ids": ",".join(batch),
+            "per_page": BATCH_MAX_IDS,
+        })
+        if isinstance(rows, list):
+            found = {row["id"]: row for row in rows}
+        elif rows is not None:
+            logger.error("Unexpected /coins/markets payload: %s",
+                         type(rows).__name__)
+    except NotFoundError:
+        pass
     except Exception as e:
-        logger.error(f"API request failed: {e}")
+        logger.error("Error fetching token batch: %s", e)
+    finally:
+        # The batch was already taken out of PENDING_TOKENS, so every waiter
+        # must get an answer here, even if this task failed or was cancelled.
+        for coin_id, future in batch.items():
+            if future.done():  # caller gave up
+                continue
+            if found is None:
+                future.set_result(None)
+            elif coin_id in found:
+                future.set_result(found[coin_id])
+            else:
+                # Unknown ids are simply missing from the batch, not a 404
+                future.set_exception(NotFoundError(coin_id))
+
+
+async def fetch_token_data(coin_id):
+    try:
+        return await CACHE.get_or_fetch(f"coin:{coin_id}", TOKEN_TTL,
+                                        lambda: queue_token(coin_id))
+    except NotFoundError:
+        remember_unknown_token(coin_id)
+        return None
+    except Exception as e:
+        logger.error("Error fetching token data: %s", e)
         return None
 
 
-def fetch_token_data(coin_id):
+async def fetch_chart_data(coin_id, hours=CHART_WINDOW_HOURS):
+    # /market_chart/range takes an explicit window, so longer views can be
+    # served by one call; ranges up to a day come back at 5-minute points.
     try:
-        url = f"{COINGECKO_API}/coins/{coin_id}"
-        response = api_request(url, {"localization": "false"})
-        return response.json() if response else None
+        url = COINGECKO_API / "coins" / coin_id / "market_chart" / "range"
+        now = int(time.time())
+        params = {
+            "vs_currency": "usd",
+            "from": now - hours * 60 * 60,
+            "to": now,
+        }
+
+        # Parsed once per fetch into an (N, 2) [ms, price] array: cached
+        # hits skip the conversion and the array pickles to render workers
+        # as one buffer instead of N small lists.
+        async def fetch():
+            data = await api_request(url, params)
+            if data is None:
+                return None
+            return np.asarray(data.get("prices", []),
+                              dtype=np.float64).reshape(-1, 2)
+
+        return await CACHE.get_or_fetch(f"chart:{coin_id}:{hours}", CHART_TTL,
+                                        fetch)
+    except NotFoundError:
+        remember_unknown_token(coin_id)
+        return None
     except Exception as e:
-        logger.error(f"Error fetching token data: {e}")
+        logger.error("Error fetching chart data: %s", e)
         return None
 
 
-def fetch_chart_data(coin_id):
+async def download_logo(logo_url):
     try:
-        url = f"{COINGECKO_API}/coins/{coin_id}/market_chart"
-        params = {"vs_currency": "usd", "days": 1}
-        response = api_request(url, params)
-        return response.json() if response else None
+        async with get_session().get(logo_url) as response:
+            response.raise_for_status()
+            return await response.read()
     except Exception as e:
-        logger.error(f"Error fetching chart data: {e}")
+        logger.warning("Logo download failed: %s", e)
         return None
 
 
+async def fetch_logo(logo_url):
+    # Raw bytes are cached by URL so repeat coins skip the CDN round-trip;
+    # the decoded, resized image is cached separately by prepare_logo.
+    return await CACHE.get_or_fetch(f"logo:{logo_url}", LOGO_TTL,
+                                    lambda: download_logo(logo_url))
+
+
+async def fetch_token_and_logo(coin_id):
+    # The logo URL lives in the token payload, so the logo download is
+    # chained here and the whole chain overlaps with the chart request.
+    token_info = await fetch_token_data(coin_id)
+    if not token_info:
+        return None, None
+    return token_info, await fetch_logo(token_info['image'])
+
+
+def kmeans_dominant_rgb(image):
+    # Cluster the pixels and take the center of the most populated cluster;
+    # this tracks the perceived brand color better than exact-bin counting.
+    pixels = np.asarray(image.resize((32, 32)).convert('RGB'))
+    pixels = pixels.reshape(-1, 3).astype(np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+    # k-means++ seeding is random; a fixed seed makes every render worker
+    # pick the same color for the same logo.
+    cv2.setRNGSeed(0)
+    _, labels, centers = cv2.kmeans(pixels, 3, None, criteria, 3,
+                                    cv2.KMEANS_PP_CENTERS)
+    best = np.bincount(labels.ravel()).argmax()
+    return tuple(int(c) for c in centers[best])
+
+
+def bincount_dominant_rgb(image):
+    # thumbnail() shrinks in place with a cheap reduce step first, so work
+    # on a copy; a 32x32 sample is plenty for a color histogram.
+    sample = image.convert('RGB')
+    sample.thumbnail((32, 32))
+    pixels = np.asarray(sample)
+
+    # Bucket each channel to 4 bits and count the 4096 possible colors
+    quantized = (pixels >> 4).astype(np.uint16)
+    index = (quantized[..., 0] << 8) | (quantized[..., 1] << 4) | quantized[..., 2]
+    best = int(np.bincount(index.ravel(), minlength=4096).argmax())
+
+    # Decode to the bucket center
+    return ((best >> 8) << 4 | 8, (best >> 4 & 0xF) << 4 | 8,
+            (best & 0xF) << 4 | 8)
+
+
 def get_dominant_color(image):
     try:
-        image = image.resize((50, 50))
-        result = image.convert('RGB').getcolors(50 * 50)
-        if not result:
-            return "#16c784"  # Fallback color
-
-        rgb = max(result, key=lambda x: x[0])[1]
-        return (rgb[0] / 255, rgb[1] / 255, rgb[2] / 255
-                )  # Convert to 0-1 range
+        if cv2 is not None:
+            rgb = kmeans_dominant_rgb(image)
+        else:
+            rgb = bincount_dominant_rgb(image)
+        return tuple(rgb)
+    except Exception as e:
+        logger.error("Color detection error: %s", e)
+        return (22, 199, 132)  # Fallback color (#16c784)
+
+
+@functools.lru_cache(maxsize=512)
+def prepare_logo(logo_bytes):
+    # A coin's logo doesn't change, so decoding, resizing and picking the
+    # chart color happen once per logo; repeat cards reuse the result.
+    try:
+        logo = Image.open(io.BytesIO(logo_bytes)).convert("RGBA")
     except Exception as e:
-        logger.error(f"Color detection error: {e}")
-        return "#16c784"
+        logger.warning("Logo decode failed: %s", e)
+        logo = Image.new("RGBA", (100, 100), (30, 30, 30))
+
+    dominant_color = get_dominant_color(logo)
+    return logo.resize((80, 80), Image.Resampling.BILINEAR), dominant_color
+
 
+def draw_sparkline(timestamps, prices, color, size=(400, 200), scale=2):
+    # Plain Pillow line + area fill. Drawn at 2x and downsampled so the
+    # line is smoothed without Matplotlib's layout and PNG round-trip.
+    width, height = size[0] * scale, size[1] * scale
+    pad = 4 * scale
+    span = max(timestamps[-1] - timestamps[0], 1)
+    low, high = prices.min(), prices.max()
+    xs = pad + (timestamps - timestamps[0]) / span * (width - 1 - 2 * pad)
+    ys = (height - 1 - pad) - (prices - low) / max(high - low, 1e-12) * (
+        height - 1 - 2 * pad)
+    line = list(zip(xs.tolist(), ys.tolist()))
 
-def generate_image_card(token_info, chart_data):
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.polygon(line + [(line[-1][0], height - 1 - pad),
+                         (line[0][0], height - 1 - pad)],
+                 fill=color + (51, ))
+    draw.line(line, fill=color + (255, ), width=2 * scale, joint="curve")
+    return img.resize(size, Image.Resampling.BILINEAR)
+
+
+def generate_image_card(token_info, points, logo_bytes):
     try:
         name = token_info['name']
         symbol = token_info['symbol'].upper()
-        price = token_info['market_data']['current_price']['usd']
-        market_cap = token_info['market_data']['market_cap']['usd']
-        volume = token_info['market_data']['total_volume']['usd']
-        change_1h = token_info['market_data'][
-            'price_change_percentage_1h_in_currency']['usd']
-        change_24h = token_info['market_data'][
-            'price_change_percentage_24h_in_currency']['usd']
-        change_7d = token_info['market_data'][
-            'price_change_percentage_7d_in_currency']['usd']
-        logo_url = token_info['image']['large']
-
-        # Download logo
-        try:
-            logo_resp = requests.get(logo_url, timeout=10)
-            logo = Image.open(io.BytesIO(logo_resp.content)).convert("RGBA")
-        except Exception as e:
-            logger.warning(f"Logo download failed: {e}")
-            logo = Image.new("RGBA", (100, 100), (30, 30, 30))
+        price = token_info['current_price']
+        market_cap = token_info['market_cap']
+        volume = token_info['total_volume']
+        change_1h = token_info['price_change_percentage_1h_in_currency']
+        change_24h = token_info['price_change_percentage_24h_in_currency']
+        change_7d = token_info['price_change_percentage_7d_in_currency']
 
-        dominant_color = get_dominant_color(logo)
+        logo, dominant_color = prepare_logo(logo_bytes)
 
         # Generate chart
-        timestamps = [
-            datetime.fromtimestamp(p[0] / 1000) for p in chart_data["prices"]
-        ]
-        prices = [p[1] for p in chart_data["prices"]]
-
-        fig, ax = plt.subplots(figsize=(6, 3), dpi=100)
-        ax.plot(timestamps, prices, color=dominant_color, linewidth=2)
-        ax.fill_between(timestamps,
-                        prices,
-                        min(prices),
-                        alpha=0.2,
-                        color=dominant_color)
-        ax.axis("off")
-
-        chart_buf = io.BytesIO()
-        plt.savefig(chart_buf,
-                    format="png",
-                    transparent=True,
-                    bbox_inches='tight')
-        plt.close(fig)
-        chart_buf.seek(0)
-        chart_img = Image.open(chart_buf).convert("RGBA")
+        chart_img = draw_sparkline(points[:, 0], points[:, 1], dominant_color)
 
         # Compose final image
-        card = Image.new("RGBA", (800, 400), (20, 20, 20))
+        card = CARD_TEMPLATE.copy()
         draw = ImageDraw.Draw(card)
 
-        # Fonts
-        font_bold = get_font("dejavu-sans-bold.ttf", 40)
-        font_small = get_font("dejavu-sans.ttf", 20)
-
         # Paste logo
-        logo = logo.resize((80, 80))
         card.paste(logo, (30, 30), logo)
 
         # Text elements
         text_config = [
-            (130, 30, name, font_bold, "white"),
-            (130, 80, symbol, font_small, "gray"),
-            (30, 140, f"${price:,.2f}", font_bold, "white"),
-            (30, 190, f"Market Cap: ${market_cap:,.0f}", font_small, "gray"),
-            (30, 220, f"24h Volume: ${volume:,.0f}", font_small, "gray"),
-            (30, 260, f"📈 1h: {change_1h:.2f}%", font_small, "white"),
-            (30, 290, f"24h: {change_24h:.2f}%", font_small, "white"),
-            (30, 320, f"7d: {change_7d:.2f}%", font_small, "white")
+            (130, 30, name, FONT_BOLD, "white"),
+            (130, 80, symbol, FONT_SMALL, "gray"),
+            (30, 140, f"${price:,.2f}", FONT_BOLD, "white"),
         ]
+        values = [
+            f"${market_cap:,.0f}",
+            f"${volume:,.0f}",
+            f"{change_1h:.2f}%",
+            f"{change_24h:.2f}%",
+            f"{change_7d:.2f}%",
+        ]
+        for (x, y, color), value in zip(CARD_VALUE_POS, values):
+            text_config.append((x, y, value, FONT_SMALL, color))
 
         for x, y, text, font, color in text_config:
             draw.text((x, y), text, font=font, fill=color)
 
         # Paste chart
-        chart_img = chart_img.resize((400, 200))
         card.paste(chart_img, (380, 180), chart_img)
 
         # Watermark
-        draw.text((760, 370),
-                  "@rivxlabs",
-                  font=font_small,
-                  fill="gray",
-                  anchor="rs")
+        card.alpha_composite(WATERMARK, WATERMARK_POS)
 
+        # The card is opaque; dropping alpha makes the PNG smaller
         output = io.BytesIO()
-        card.save(output, format="PNG")
-        output.seek(0)
-        return output
+        card.convert("RGB").save(output,
+                                 format="PNG",
+                                 compress_level=PNG_COMPRESS_LEVEL)
+        return output.getvalue()
+    except Exception as e:
+        logger.error("Image generation error: %s", e)
+        return None
+
+
+def generate_chart(points, symbol):
+    try:
+        timestamps = points[:, 0] / MS_PER_DAY  # days since the 1970 epoch
+        prices = points[:, 1]
+        color = "#16c784" if prices[-1] >= prices[0] else "#ea3943"
+
+        fig = acquire_figure(CHART_SIZE, setup_chart_figure)
+        try:
+            ax = fig.axes[0]
+            ax.plot(timestamps, prices, color=color, linewidth=2)
+            ax.set_title(f"{symbol} · 24h", color="white")
+
+            # Draw straight to the Agg buffer and encode it with Pillow,
+            # skipping savefig's per-call bookkeeping. The chart is opaque,
+            # so alpha is dropped for a smaller PNG.
+            fig.canvas.draw()
+            img = Image.frombuffer("RGBA", fig.canvas.get_width_height(),
+                                   fig.canvas.buffer_rgba()).convert("RGB")
+        finally:
+            release_figure(fig, CHART_SIZE)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+        return buf.getvalue()
     except Exception as e:
-        logger.error(f"Image generation error: {e}")
+        logger.error("Chart generation error: %s", e)
         return None
 
 
+# === Text Fallback ===
+PRICE_TEMPLATE = ("🔸 {name} ({symbol})\n"
+                  "Price: ${price:,.2f}\n"
+                  "Market Cap: ${market_cap:,.2f}\n"
+                  "24h Volume: ${volume:,.2f}\n\n"
+                  "📈 Market Change\n"
+                  "1h: {change_1h:.2f}%\n"
+                  "24h: {change_24h:.2f}%\n"
+                  "7d: {change_7d:.2f}%")
+
+
+def format_price(token_info, symbol):
+    return PRICE_TEMPLATE.format_map({
+        "name": token_info["name"],
+        "symbol": symbol,
+        "price": token_info["current_price"],
+        "market_cap": token_info["market_cap"],
+        "volume": token_info["total_volume"],
+        "change_1h": token_info["price_change_percentage_1h_in_currency"],
+        "change_24h": token_info["price_change_percentage_24h_in_currency"],
+        "change_7d": token_info["price_change_percentage_7d_in_currency"],
+    })
+
+
 # === Telegram Handlers ===
+async def build_card(coin_id):
+    # Returns (token_info, png); token_info is None when data is missing
+    # and png is None when rendering failed.
+    token_result, chart_info = await asyncio.wait_for(
+        asyncio.gather(fetch_token_and_logo(coin_id),
+                       fetch_chart_data(coin_id),
+                       return_exceptions=True), HANDLER_TIMEOUT)
+
+    if isinstance(token_result, Exception):
+        logger.error("Error fetching token data: %s", token_result)
+        token_result = (None, None)
+    if isinstance(chart_info, Exception):
+        logger.error("Error fetching chart data: %s", chart_info)
+        chart_info = None
+    token_info, logo_bytes = token_result
+
+    if not token_info or chart_info is None:
+        return None, None
+
+    # Rendered PNGs are reused within the window their data is cached for
+    bucket = int(time.time() // TOKEN_TTL)
+    try:
+        img = await CACHE.get_or_fetch(
+            f"png:card:{coin_id}:{bucket}", TOKEN_TTL,
+            lambda: render(generate_image_card, token_info, chart_info,
+                           logo_bytes))
+    except Exception as e:
+        logger.error("Image render failed: %s", e)
+        img = None
+    return token_info, img
+
+
+@limit_per_user
 async def price_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text(
             "❌ Please provide a token. Example: /p bitcoin")
         return
 
-    token = context.args[0].lower()
-    coin_id = SYMBOL_TO_ID.get(token, token)
+    token = normalize_token(context.args[0])
+    await ensure_symbol_mapping()
+    coin_id = resolve_coin_id(token)
+    if coin_id is None or is_unknown_token(coin_id):
+        await update.message.reply_text("❌ Unknown token")
+        return
 
-    token_info = fetch_token_data(coin_id)
-    chart_info = fetch_chart_data(coin_id)
+    try:
+        token_info, img = await coalesce(("card", coin_id),
+                                         lambda: build_card(coin_id))
+    except asyncio.TimeoutError:
+        await update.message.reply_text("❌ Upstream slow, try again")
+        return
 
-    if not token_info or not chart_info:
+    if not token_info:
         await update.message.reply_text(
+            "❌ Unknown token" if is_unknown_token(coin_id) else
             "❌ Could not retrieve token/chart data.")
         return
 
-    img = generate_image_card(token_info, chart_info)
     if img:
-        await update.message.reply_photo(photo=InputFile(img))
+        await update.message.reply_photo(
+            photo=InputFile(img, filename="card.png"))
     else:
         try:
-            md = token_info["market_data"]
-            text = (
-                f"🔸 {token_info['name']} ({token.upper()})\n"
-                f"Price: ${md['current_price']['usd']:,.2f}\n"
-                f"Market Cap: ${md['market_cap']['usd']:,.2f}\n"
-                f"24h Volume: ${md['total_volume']['usd']:,.2f}\n\n"
-                f"📈 Market Change\n"
-                f"1h: {md['price_change_percentage_1h_in_currency']['usd']:.2f}%\n"
-                f"24h: {md['price_change_percentage_24h_in_currency']['usd']:.2f}%\n"
-                f"7d: {md['price_change_percentage_7d_in_currency']['usd']:.2f}%"
-            )
-            await update.message.reply_text(text)
+            await update.message.reply_text(
+                format_price(token_info, token.upper()))
         except Exception as e:
-            logger.error(f"Fallback error: {e}")
+            logger.error("Fallback error: %s", e)
             await update.message.reply_text("❌ Error generating response")
 
 
+@limit_per_user
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text(
+            "❌ Please provide a token. Example: /c bitcoin")
+        return
+
+    token = normalize_token(context.args[0])
+    await ensure_symbol_mapping()
+    coin_id = resolve_coin_id(token)
+    if coin_id is None or is_unknown_token(coin_id):
+        await update.message.reply_text("❌ Unknown token")
+        return
+
+    try:
+        chart_info = await asyncio.wait_for(fetch_chart_data(coin_id),
+                                            HANDLER_TIMEOUT)
+    except asyncio.TimeoutError:
+        await update.message.reply_text("❌ Upstream slow, try again")
+        return
+
+    if chart_info is None:
+        await update.message.reply_text(
+            "❌ Unknown token" if is_unknown_token(coin_id) else
+            "❌ Could not retrieve chart data.")
+        return
+
+    symbol = token.upper()
+    bucket = int(time.time() // CHART_TTL)
+    try:
+        img = await CACHE.get_or_fetch(
+            f"png:chart:{coin_id}:{symbol}:{bucket}", CHART_TTL,
+            lambda: render(generate_chart, chart_info, symbol))
+    except Exception as e:
+        logger.error("Chart render failed: %s", e)
+        img = None
+    if img:
+        await update.message.reply_photo(
+            photo=InputFile(img, filename="chart.png"))
+    else:
+        await update.message.reply_text("❌ Error generating chart")
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🤖 *RIVX Crypto Bot*\n\n"
         "Use `/p [symbol]` to get price data\n"
+        "Use `/c [symbol]` to get a 24h chart\n"
         "Examples:\n`/p btc` - Bitcoin\n`/p eth` - Ethereum\n`/p doge` - Dogecoin",
         parse_mode="Markdown")
 
 
+# === Lifecycle ===
+async def post_init(application: Application):
+    global WARMUP_TASK, SYMBOL_MAP_TASK, SYMBOL_REFRESH_TASK
+    WARMUP_TASK = asyncio.create_task(warm_connection())
+    get_render_pool().submit(int)  # spawn a worker before the first command
+    # Polling starts without waiting on CoinGecko; see ensure_symbol_mapping
+    SYMBOL_MAP_TASK = asyncio.create_task(load_symbol_mapping())
+    SYMBOL_REFRESH_TASK = asyncio.create_task(refresh_symbol_mapping())
+
+
+async def post_shutdown(application: Application):
+    for task in (WARMUP_TASK, SYMBOL_MAP_TASK, SYMBOL_REFRESH_TASK,
+                 BATCH_TASK):
+        if task:
+            task.cancel()
+    if SESSION:
+        await SESSION.close()
+    if RENDER_POOL:
+        RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+
+
 # === Main Execution ===
 if __name__ == "__main__":
-    nest_asyncio.apply()
-    load_symbol_mapping()
-
-    async def main():
-        app = ApplicationBuilder().token(BOT_TOKEN).build()
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("p", price_card))
-        logger.info("✅ Bot is running...")
-        await app.run_polling()
-
-    import asyncio
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.install()
+    # PTB handles updates one at a time by default; let commands overlap
+    # so one slow upstream call doesn't queue everyone behind it. Replies
+    # are then shaped to Telegram's flood limits (30 msg/s overall, 20
+    # msg/min per group) instead of tripping 429s.
+    app = (ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True)
+           .rate_limiter(AIORateLimiter())
+           .post_init(post_init).post_shutdown(post_shutdown).build())
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("p", price_card))
+    app.add_handler(CommandHandler("c", chart))
+    logger.info("✅ Bot is running...")
+    # PTB owns the event loop; no nested asyncio.run() needed.
+    app.run_polling()